@@ -0,0 +1,155 @@
+"""
+LLM Request Batching
+Coalesces prompts that arrive close together into a single numbered LLM call.
+"""
+
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+GenerateFn = Callable[[str, str], Awaitable[str]]
+
+_NUMBERED_LINE = re.compile(r"^\s*(\d+)\s*[\).:]\s*(.*)$")
+
+
+def parse_numbered_response(text: str) -> Dict[int, str]:
+    """Split a "1) ... 2) ..." style reply into {number: answer}.
+
+    Lines that don't start with a number are treated as a continuation of the previous answer.
+    """
+    answers: Dict[int, List[str]] = {}
+    current: Optional[int] = None
+    for line in text.splitlines():
+        match = _NUMBERED_LINE.match(line)
+        if match:
+            current = int(match.group(1))
+            answers[current] = [match.group(2).strip()]
+        elif current is not None and line.strip():
+            answers[current].append(line.strip())
+    return {num: " ".join(parts).strip() for num, parts in answers.items()}
+
+
+class BatchingLLM:
+    """Collects prompts for a short window and answers them with one LLM call.
+
+    Callers `await submit(item)` and get back their own answer (or None if the model
+    skipped it). Up to `max_batch` items queued within `window` seconds of the first
+    one share a request, which keeps bursts under the API's requests-per-minute limit.
+    Each batch is sent as its own task, with at most `max_concurrent` calls in flight.
+    """
+
+    def __init__(
+        self,
+        generate: GenerateFn,
+        system_message: str,
+        instruction: str,
+        max_batch: int = 8,
+        window: float = 0.1,
+        max_concurrent: int = 4,
+    ):
+        self._generate = generate
+        self._system_message = system_message
+        self._instruction = instruction
+        self._max_batch = max_batch
+        self._window = window
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._slots = asyncio.Semaphore(max_concurrent)
+        # Batches currently being sent, keyed by their dispatch task
+        self._inflight: Dict[asyncio.Task, List[Tuple[str, asyncio.Future]]] = {}
+
+    def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        # Abandon batches still being sent and release their callers
+        # (snapshot first: the done callback drops each batch from _inflight as its task ends)
+        inflight = list(self._inflight.items())
+        for task, _ in inflight:
+            task.cancel()
+        await asyncio.gather(*(task for task, _ in inflight), return_exceptions=True)
+        for _, batch in inflight:
+            self._release(batch)
+        # Release anyone still waiting on a queued item
+        while self._queue is not None and not self._queue.empty():
+            self._release([self._queue.get_nowait()])
+        self._queue = None
+
+    @staticmethod
+    def _release(batch: List[Tuple[str, asyncio.Future]]):
+        for _, fut in batch:
+            if not fut.done():
+                fut.set_result(None)
+
+    async def submit(self, item: str) -> Optional[str]:
+        if self._queue is None:
+            raise RuntimeError("BatchingLLM is not started")
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            try:
+                deadline = loop.time() + self._window
+                while len(batch) < self._max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Wait for a free slot here, so batches keep filling while calls are in flight
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                # Stopped while this batch was still being collected
+                self._release(batch)
+                raise
+            task = asyncio.create_task(self._dispatch(batch))
+            self._inflight[task] = batch
+            task.add_done_callback(self._on_dispatch_done)
+
+    def _on_dispatch_done(self, task: asyncio.Task):
+        self._inflight.pop(task, None)
+        self._slots.release()
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future]]):
+        # Flatten each item to one line so its contents can't pose as another numbered item
+        numbered = "\n\n".join(f"{i}) {' '.join(item.split())}" for i, (item, _) in enumerate(batch, 1))
+        prompt = (
+            f"{self._instruction}\n\n"
+            f'Reply with exactly one line per item, formatted as "<number>) <answer>", and nothing else.\n\n'
+            f"{numbered}"
+        )
+        try:
+            response = await self._generate(self._system_message, prompt)
+        except Exception as e:
+            logging.error(f"Batched LLM call failed for {len(batch)} item(s): {e}")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        answers = parse_numbered_response(response or "")
+        if len(batch) == 1 and not answers.get(1) and response and response.strip():
+            # A lone item needs no numbering; accept an unprefixed reply as its answer
+            answers[1] = response.strip()
+        missing = [i for i in range(1, len(batch) + 1) if not answers.get(i)]
+        if missing:
+            logging.warning(f"Batched LLM reply had no answer for item(s) {missing} of {len(batch)}")
+        for i, (_, fut) in enumerate(batch, 1):
+            if not fut.done():
+                fut.set_result(answers.get(i) or None)
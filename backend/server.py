@@ -1,17 +1,22 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import os
 import logging
 from pathlib import Path
+from dataclasses import dataclass
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Literal, Optional, Dict, Any
 import uuid
 from datetime import datetime, timedelta
 import jwt
 from passlib.hash import bcrypt
+from cachetools import TTLCache
 import asyncio
+import hashlib
+import time
 import json
 import base64
 from io import BytesIO
@@ -21,6 +26,7 @@ from PIL import Image
 import aiomysql
 
 from health_scoring import compute_health_score
+from llm_batching import BatchingLLM
 
 # Google Gemini
 import google.generativeai as genai
@@ -32,6 +38,8 @@ load_dotenv(ROOT_DIR / '.env')
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
 GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-1.5-flash')
 if GEMINI_API_KEY:
+    # The SDK keeps one default client per process (gRPC, multiplexed over a single HTTP/2
+    # channel), so calls already reuse the same connection; there's no per-call HTTP client to pool.
     genai.configure(api_key=GEMINI_API_KEY)
 
 # Note: Using Gemini Vision for OCR (FREE - no billing required!)
@@ -50,6 +58,20 @@ JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production'
 JWT_ALGORITHM = 'HS256'
 JWT_EXPIRATION_DAYS = 30
 
+# bcrypt cost factor for new hashes; existing hashes verify at whatever cost they were made with
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', '12'))
+password_hasher = bcrypt.using(rounds=BCRYPT_ROUNDS)
+
+# Decoded JWT payloads keyed by a short digest of the token, so repeat requests
+# with the same token skip signature verification. Only `exp` is re-checked on a hit.
+_jwt_cache: TTLCache = TTLCache(maxsize=10000, ttl=30)
+
+# username -> users.id, so protected endpoints don't hit the users table per request.
+_user_id_cache: TTLCache = TTLCache(maxsize=50000, ttl=300)
+
+# user_id -> formatted health profile section of the chat system prompt; dropped on profile writes
+_profile_ctx_cache: TTLCache = TTLCache(maxsize=10000, ttl=300)
+
 
 async def ensure_database_pool() -> aiomysql.Pool:
     """Create an aiomysql pool, creating the target database if it doesn't exist.
@@ -130,11 +152,11 @@ async def execute(query: str, params: tuple = ()) -> int:
     if db_pool is None:
         raise RuntimeError('Database pool is not initialized')
     async with db_pool.acquire() as conn:
-        async with conn.cursor(aiomysql.DictCursor) as cur:
+        # The pool runs with autocommit=True, so the statement is already committed;
+        # an explicit COMMIT would only cost another round trip.
+        async with conn.cursor() as cur:
             await cur.execute(query, params)
-            last_id = cur.lastrowid or 0
-            await conn.commit()
-            return last_id
+            return cur.lastrowid or 0
 
 async def init_db(conn: aiomysql.Connection):
     async with conn.cursor() as cur:
@@ -276,25 +298,83 @@ async def init_db(conn: aiomysql.Connection):
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
             """
         )
+        # Indexes for the per-user "latest first" reads (users.username is already UNIQUE)
+        await ensure_index(cur, "timeline_entries", "idx_timeline_user_ts", "user_id, timestamp")
+        await ensure_index(cur, "chat_messages", "idx_chat_user_ts", "user_id, timestamp")
+        await ensure_index(cur, "prescriptions", "idx_prescriptions_user_created", "user_id, created_at")
+        try:
+            await ensure_index(cur, "health_profiles", "uq_health_profiles_user", "user_id", unique=True)
+        except Exception as e:
+            # Existing duplicate profiles would block the unique key; don't fail startup over it
+            logging.warning(f"Could not add unique index on health_profiles.user_id: {e}")
         await conn.commit()
 
+async def ensure_index(cur, table: str, name: str, columns: str, unique: bool = False):
+    """Add an index if it isn't there yet (MySQL has no CREATE INDEX IF NOT EXISTS).
+
+    Uses online DDL so adding it to an existing, populated table doesn't block writes.
+    """
+    await cur.execute(
+        "SELECT 1 FROM information_schema.statistics WHERE table_schema=DATABASE() AND table_name=%s AND index_name=%s LIMIT 1",
+        (table, name),
+    )
+    if await cur.fetchone():
+        return
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    await cur.execute(
+        f"ALTER TABLE `{table}` ADD {kind} `{name}` ({columns}), ALGORITHM=INPLACE, LOCK=NONE"
+    )
+
 def to_dt(dt: datetime) -> datetime:
     # Ensures datetime is naive UTC for MySQL compatibility
     if isinstance(dt, datetime):
         return dt.replace(tzinfo=None)
     return dt
 
+# Strong refs to fire-and-forget tasks so they aren't garbage-collected mid-flight
+_bg_tasks: set = set()
+# How long shutdown waits for those tasks before closing the DB pool
+BACKGROUND_SHUTDOWN_TIMEOUT = 10
+
+def _on_bg_task_done(task: asyncio.Task):
+    _bg_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error(f"Background task failed: {task.exception()}")
+
+def spawn_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_on_bg_task_done)
+    return task
+
+def get_gemini_model(system_message: Optional[str] = None) -> genai.GenerativeModel:
+    # Cheap to build (no I/O); the underlying async client is created once and shared, so
+    # there's nothing to cache here, and chat system prompts carry per-user health data anyway
+    return genai.GenerativeModel(model_name=GEMINI_MODEL, system_instruction=system_message)
+
 async def gemini_generate(system_message: str, user_text: str) -> str:
     try:
-        model = genai.GenerativeModel(model_name=GEMINI_MODEL, system_instruction=system_message)
+        model = get_gemini_model(system_message)
         resp = await model.generate_content_async(user_text)
         return (resp.text or "").strip()
     except Exception as e:
         logging.error(f"Gemini error: {e}")
         raise
 
-# Create the main app
-app = FastAPI()
+async def gemini_stream(system_message: str, user_text: str):
+    """Yield response text chunks as Gemini produces them."""
+    try:
+        model = get_gemini_model(system_message)
+        resp = await model.generate_content_async(user_text, stream=True)
+        async for chunk in resp:
+            if chunk.text:
+                yield chunk.text
+    except Exception as e:
+        logging.error(f"Gemini error: {e}")
+        raise
+
+# Create the main app (orjson for response encoding; it also handles datetimes natively)
+app = FastAPI(default_response_class=ORJSONResponse)
 api_router = APIRouter(prefix="/api")
 security = HTTPBearer()
 
@@ -314,12 +394,12 @@ class TokenResponse(BaseModel):
     username: str
 
 class HealthProfileCreate(BaseModel):
-    sleep_pattern: str  # "early_bird", "night_owl", "irregular"
+    sleep_pattern: Literal["early_bird", "night_owl", "irregular"]
     sleep_hours: int  # average hours per night
-    hydration_level: str  # "poor", "moderate", "good"
-    stress_level: str  # "low", "moderate", "high"
-    exercise_frequency: str  # "never", "occasional", "regular", "daily"
-    diet_type: str  # "balanced", "vegetarian", "vegan", "fast_food", "other"
+    hydration_level: Literal["poor", "moderate", "good"]
+    stress_level: Literal["low", "moderate", "high"]
+    exercise_frequency: Literal["never", "occasional", "regular", "daily"]
+    diet_type: Literal["balanced", "vegetarian", "vegan", "fast_food", "other"]
     existing_conditions: Optional[str] = None
     lifestyle_notes: Optional[str] = None
 
@@ -368,25 +448,65 @@ class ChatHistoryResponse(BaseModel):
 
 # ==================== AUTH HELPERS ====================
 
-def create_token(username: str) -> str:
+@dataclass
+class AuthCtx:
+    username: str
+    user_id: int
+
+def create_token(username: str, user_id: int) -> str:
     payload = {
-        'username': username,
+        'sub': username,
+        'uid': user_id,
         'exp': datetime.utcnow() + timedelta(days=JWT_EXPIRATION_DAYS)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> str:
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        username = payload.get('username')
-        if not username:
+async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)) -> AuthCtx:
+    token = credentials.credentials
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    payload = _jwt_cache.get(key)
+    if payload is not None:
+        exp = payload.get('exp')
+        if exp is not None and exp <= time.time():
+            _jwt_cache.pop(key, None)
+            raise HTTPException(status_code=401, detail="Token expired")
+    else:
+        try:
+            payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        except jwt.ExpiredSignatureError:
+            raise HTTPException(status_code=401, detail="Token expired")
+        except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail="Invalid token")
-        return username
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        if not (payload.get('sub') or payload.get('username')):
+            raise HTTPException(status_code=401, detail="Invalid token")
+        _jwt_cache[key] = payload
+
+    username = payload.get('sub') or payload.get('username')
+    user_id = payload.get('uid')
+    if user_id is None:
+        # Tokens issued before the user id was embedded only carry the username
+        user_id = await resolve_user_id(username)
+    return AuthCtx(username=username, user_id=int(user_id))
+
+async def hash_password(password: str) -> str:
+    # bcrypt is CPU-bound; run it in the default thread pool so it doesn't stall the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, password_hasher.hash, password)
+
+async def verify_password(password: str, password_hash: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, password_hasher.verify, password, password_hash)
+
+async def resolve_user_id(username: str) -> int:
+    user_id = _user_id_cache.get(username)
+    if user_id is not None:
+        return user_id
+    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    user_id = int(user["id"])
+    _user_id_cache[username] = user_id
+    return user_id
 
 # ==================== AUTH ENDPOINTS ====================
 
@@ -398,17 +518,18 @@ async def register(user: UserRegister):
         raise HTTPException(status_code=400, detail="Username already exists")
 
     # Hash password
-    hashed_password = bcrypt.hash(user.password)
+    hashed_password = await hash_password(user.password)
 
     # Create user
     created_at = to_dt(datetime.utcnow())
-    await execute(
+    user_id = await execute(
         "INSERT INTO users (username, email, password_hash, created_at) VALUES (%s, %s, %s, %s)",
         (user.username, user.email, hashed_password, created_at)
     )
+    _user_id_cache.pop(user.username, None)
 
     # Create token
-    token = create_token(user.username)
+    token = create_token(user.username, user_id)
 
     return TokenResponse(token=token, username=user.username)
 
@@ -420,59 +541,74 @@ async def login(user: UserLogin):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     # Verify password
-    if not bcrypt.verify(user.password, user_doc["password_hash"]):
+    if not await verify_password(user.password, user_doc["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
     # Create token
-    token = create_token(user.username)
+    token = create_token(user.username, int(user_doc["id"]))
 
     return TokenResponse(token=token, username=user.username)
 
 # ==================== HEALTH PROFILE ENDPOINTS ====================
 
-@api_router.post("/health/profile", response_model=HealthProfileResponse)
-async def create_or_update_health_profile(
-    profile: HealthProfileCreate,
-    username: str = Depends(verify_token)
-):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
-    
-    # Generate health persona using Gemini
-    persona_prompt = f"""
-Based on this health profile, create a fun and engaging "health persona" in 1-2 sentences:
-
-- Sleep Pattern: {profile.sleep_pattern} ({profile.sleep_hours} hours)
-- Hydration: {profile.hydration_level}
-- Stress Level: {profile.stress_level}
-- Exercise: {profile.exercise_frequency}
-- Diet: {profile.diet_type}
+DEFAULT_HEALTH_PERSONA = "Health Warrior in Training"
+
+# Personas for profiles saved close together are generated in one Gemini call
+persona_batcher = BatchingLLM(
+    gemini_generate,
+    system_message="You are a creative health coach who creates fun, memorable health personas.",
+    instruction=(
+        'For each numbered health profile below, create a fun and engaging "health persona" in 1-2 sentences. '
+        'Treat every profile on its own: base each answer only on that item and never mention the others. '
+        'Make it playful and memorable, like "You\'re a Night Owl Strategist" or "You\'re a Zen Snacker".'
+    ),
+)
 
-Make it playful and memorable, like "You're a Night Owl Strategist" or "You're a Zen Snacker".
-"""
-    
-    health_persona = "Health Warrior in Training"  # Default
+async def _generate_persona_later(user_id: int, profile: HealthProfileCreate, updated_at: datetime):
+    """Generate the health persona with Gemini and store it once it's ready.
 
+    `updated_at` is the profile row's value at save time; if the profile has been saved
+    again since, this result is stale and is dropped.
+    """
+    profile_summary = (
+        f"Sleep Pattern: {profile.sleep_pattern} ({profile.sleep_hours} hours); "
+        f"Hydration: {profile.hydration_level}; "
+        f"Stress Level: {profile.stress_level}; "
+        f"Exercise: {profile.exercise_frequency}; "
+        f"Diet: {profile.diet_type}"
+    )
     try:
-        response = await gemini_generate(
-            "You are a creative health coach who creates fun, memorable health personas.",
-            persona_prompt,
-        )
-        if response:
-            health_persona = response
+        health_persona = await persona_batcher.submit(profile_summary)
     except Exception as e:
         logging.error(f"Error generating persona: {e}")
+        return
+    if not health_persona:
+        return
+
+    await execute(
+        "UPDATE health_profiles SET health_persona=%s WHERE user_id=%s AND updated_at=%s",
+        (health_persona, user_id, updated_at),
+    )
+    _profile_ctx_cache.pop(user_id, None)
+
+@api_router.post("/health/profile", response_model=HealthProfileResponse)
+async def create_or_update_health_profile(
+    profile: HealthProfileCreate,
+    ctx: AuthCtx = Depends(verify_token)
+):
+    user_id = ctx.user_id
     
     # Check if profile exists
     existing_profile = await fetch_one(
-        "SELECT * FROM health_profiles WHERE user_id=%s",
+        "SELECT id, created_at, health_persona FROM health_profiles WHERE user_id=%s",
         (user_id,)
     )
 
-    now = to_dt(datetime.utcnow())
+    # The persona is generated in the background; until then keep the current one (or the default)
+    health_persona = (existing_profile or {}).get("health_persona") or DEFAULT_HEALTH_PERSONA
+
+    # Whole seconds, matching what DATETIME stores, so the persona task can match on updated_at
+    now = to_dt(datetime.utcnow()).replace(microsecond=0)
     if existing_profile:
         await execute(
             """
@@ -527,7 +663,10 @@ Make it playful and memorable, like "You're a Night Owl Strategist" or "You're a
         profile_id = str(profile_id_int)
         updated_at = created_at
 
-    return HealthProfileResponse(
+    _profile_ctx_cache.pop(user_id, None)
+    spawn_background(_generate_persona_later(user_id, profile, updated_at))
+
+    return HealthProfileResponse.model_construct(
         id=profile_id,
         user_id=str(user_id),
         sleep_pattern=profile.sleep_pattern,
@@ -544,12 +683,8 @@ Make it playful and memorable, like "You're a Night Owl Strategist" or "You're a
     )
 
 @api_router.get("/health/profile", response_model=Optional[HealthProfileResponse])
-async def get_health_profile(username: str = Depends(verify_token)):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+async def get_health_profile(ctx: AuthCtx = Depends(verify_token)):
+    user_id = ctx.user_id
     profile = await fetch_one("SELECT * FROM health_profiles WHERE user_id=%s", (user_id,))
 
     if not profile:
@@ -576,13 +711,9 @@ async def get_health_profile(username: str = Depends(verify_token)):
 @api_router.post("/timeline/entry", response_model=TimelineEntryResponse)
 async def create_timeline_entry(
     entry: TimelineEntryCreate,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
     ts = to_dt(datetime.utcnow())
     tags_json = json.dumps(entry.tags or [])
@@ -602,7 +733,7 @@ async def create_timeline_entry(
         ),
     )
 
-    return TimelineEntryResponse(
+    return TimelineEntryResponse.model_construct(
         id=str(new_id),
         user_id=str(user_id),
         entry_type=entry.entry_type,
@@ -613,145 +744,189 @@ async def create_timeline_entry(
         timestamp=ts,
     )
 
-@api_router.get("/timeline/entries", response_model=List[TimelineEntryResponse])
+# Read-only list endpoints return rows straight from SQL (already in response shape) and skip
+# response_model validation; the models stay in `responses` for the OpenAPI docs.
+@api_router.get("/timeline/entries", responses={200: {"model": List[TimelineEntryResponse]}})
 async def get_timeline_entries(
     limit: int = 50,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
+    # ids are stringified in SQL so rows already match TimelineEntryResponse
     rows = await fetch_all(
-        "SELECT * FROM timeline_entries WHERE user_id=%s ORDER BY timestamp DESC LIMIT %s",
+        """
+        SELECT CAST(id AS CHAR) AS id, CAST(user_id AS CHAR) AS user_id, entry_type, title,
+               description, severity, tags, timestamp
+        FROM timeline_entries WHERE user_id=%s ORDER BY timestamp DESC LIMIT %s
+        """,
         (user_id, int(limit)),
     )
-    results: List[TimelineEntryResponse] = []
     for r in rows:
         try:
-            tags = json.loads(r.get("tags") or "[]")
+            r["tags"] = json.loads(r.get("tags") or "[]")
         except Exception:
-            tags = []
-        results.append(
-            TimelineEntryResponse(
-                id=str(r["id"]),
-                user_id=str(r["user_id"]),
-                entry_type=r["entry_type"],
-                title=r["title"],
-                description=r.get("description"),
-                severity=r.get("severity"),
-                tags=tags,
-                timestamp=r["timestamp"],
-            )
-        )
-    return results
+            r["tags"] = []
+    return ORJSONResponse(rows)
 
 # ==================== CHAT ENDPOINTS ====================
 
-@api_router.post("/chat/message", response_model=ChatMessageResponse)
-async def send_chat_message(
-    message: ChatMessageCreate,
-    username: str = Depends(verify_token)
-):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+async def _get_recent_prescriptions(user_id: int, limit: int = 5) -> List[Dict[str, Any]]:
+    try:
+        return await fetch_all(
+            "SELECT medication_name, dosage, frequency, timing FROM prescriptions WHERE user_id=%s ORDER BY created_at DESC LIMIT %s",
+            (user_id, limit)
+        )
+    except Exception:
+        # Non-fatal: chat continues without prescriptions
+        return []
+
+async def _save_chat_messages(user_id: int, messages: List[tuple]):
+    """Insert (role, content, timestamp) rows for one chat turn in a single statement."""
+    placeholders = ", ".join(["(%s, %s, %s, %s)"] * len(messages))
+    params: List[Any] = []
+    for role, content, ts in messages:
+        params.extend((user_id, role, content, ts))
+    await execute(
+        f"INSERT INTO chat_messages (user_id, role, content, timestamp) VALUES {placeholders}",
+        tuple(params),
+    )
 
-    # Get user's health profile for context
-    profile = await fetch_one("SELECT * FROM health_profiles WHERE user_id=%s", (user_id,))
+async def _get_profile_context(user_id: int) -> str:
+    cached = _profile_ctx_cache.get(user_id)
+    if cached is not None:
+        return cached
 
-    # Get recent timeline entries for context
-    recent_entries = await fetch_all(
-        "SELECT entry_type, title FROM timeline_entries WHERE user_id=%s ORDER BY timestamp DESC LIMIT 10",
+    profile = await fetch_one(
+        "SELECT health_persona, sleep_pattern, sleep_hours, stress_level, exercise_frequency FROM health_profiles WHERE user_id=%s",
         (user_id,),
     )
+    section = ""
+    if profile:
+        section += f"\n\nUser's Health Profile:\n"
+        section += f"- Persona: {profile.get('health_persona', 'N/A')}\n"
+        section += f"- Sleep: {profile.get('sleep_pattern')} ({profile.get('sleep_hours')}h)\n"
+        section += f"- Stress: {profile.get('stress_level')}\n"
+        section += f"- Exercise: {profile.get('exercise_frequency')}\n"
+    _profile_ctx_cache[user_id] = section
+    return section
+
+async def _build_chat_context(user_id: int) -> str:
+    # Profile, recent timeline and prescriptions are independent; fetch them concurrently so the
+    # wall-clock cost is one round trip (each query takes its own pooled connection)
+    profile_section, recent_entries, recent_pres = await asyncio.gather(
+        _get_profile_context(user_id),
+        fetch_all(
+            "SELECT entry_type, title FROM timeline_entries WHERE user_id=%s ORDER BY timestamp DESC LIMIT 5",
+            (user_id,),
+        ),
+        _get_recent_prescriptions(user_id),
+    )
     
     # Build context
-    context = "You are a helpful health assistant."
-    if profile:
-        context += f"\n\nUser's Health Profile:\n"
-        context += f"- Persona: {profile.get('health_persona', 'N/A')}\n"
-        context += f"- Sleep: {profile.get('sleep_pattern')} ({profile.get('sleep_hours')}h)\n"
-        context += f"- Stress: {profile.get('stress_level')}\n"
-        context += f"- Exercise: {profile.get('exercise_frequency')}\n"
+    context = "You are a helpful health assistant." + profile_section
     
     if recent_entries:
         context += "\n\nRecent Health Timeline:\n"
-        for entry in recent_entries[:5]:
+        for entry in recent_entries:
             context += f"- {entry.get('entry_type')}: {entry.get('title')}\n"
     # Include recent prescriptions in chat context so assistant can reference them
-    try:
-        recent_pres = await fetch_all(
-            "SELECT medication_name, dosage, frequency, timing, personalized_advice FROM prescriptions WHERE user_id=%s ORDER BY created_at DESC LIMIT 5",
-            (user_id,)
-        )
-        if recent_pres:
-            context += "\n\nRecent Prescriptions:\n"
-            for p in recent_pres:
-                med = p.get('medication_name') or 'Unknown'
-                dosage = p.get('dosage') or ''
-                freq = p.get('frequency') or p.get('timing') or ''
-                context += f"- {med}: {dosage} {freq}\n"
-            context += "\nWhen relevant, you may reference these prescriptions and suggest actions like 'take this medicine from your prescription' while reminding the user to follow doctor's instructions."
-    except Exception:
-        # Non-fatal: continue without prescriptions
-        pass
-    
-    # Save user message
+    if recent_pres:
+        context += "\n\nRecent Prescriptions:\n"
+        for p in recent_pres:
+            med = p.get('medication_name') or 'Unknown'
+            dosage = p.get('dosage') or ''
+            freq = p.get('frequency') or p.get('timing') or ''
+            context += f"- {med}: {dosage} {freq}\n"
+        context += "\nWhen relevant, you may reference these prescriptions and suggest actions like 'take this medicine from your prescription' while reminding the user to follow doctor's instructions."
+    return context
+
+@api_router.post("/chat/message", response_model=ChatMessageResponse)
+async def send_chat_message(
+    message: ChatMessageCreate,
+    ctx: AuthCtx = Depends(verify_token)
+):
+    user_id = ctx.user_id
+    context = await _build_chat_context(user_id)
+
     user_ts = to_dt(datetime.utcnow())
-    await execute(
-        "INSERT INTO chat_messages (user_id, role, content, timestamp) VALUES (%s, %s, %s, %s)",
-        (user_id, "user", message.message, user_ts),
-    )
     
     # Get AI response
     try:
         response = await gemini_generate(context, message.message)
-
-        # Save assistant message
-        assistant_ts = to_dt(datetime.utcnow())
-        await execute(
-            "INSERT INTO chat_messages (user_id, role, content, timestamp) VALUES (%s, %s, %s, %s)",
-            (user_id, "assistant", response, assistant_ts),
-        )
-
-        return ChatMessageResponse(
-            role="assistant",
-            content=response,
-            timestamp=assistant_ts,
-        )
     except Exception as e:
         logging.error(f"Error in chat: {e}")
+        # Still keep the user's message in history
+        spawn_background(_save_chat_messages(user_id, [("user", message.message, user_ts)]))
         raise HTTPException(status_code=500, detail="Failed to get AI response")
 
-@api_router.get("/chat/history", response_model=ChatHistoryResponse)
+    # Save both messages in one round trip, in the background; timestamps keep history ordering intact
+    assistant_ts = to_dt(datetime.utcnow())
+    spawn_background(_save_chat_messages(user_id, [
+        ("user", message.message, user_ts),
+        ("assistant", response, assistant_ts),
+    ]))
+
+    return ChatMessageResponse.model_construct(
+        role="assistant",
+        content=response,
+        timestamp=assistant_ts,
+    )
+
+@api_router.post("/chat/message/stream")
+async def stream_chat_message(
+    message: ChatMessageCreate,
+    ctx: AuthCtx = Depends(verify_token)
+):
+    """Same as /chat/message, but streams the reply as server-sent events.
+
+    Emits `{"delta": ...}` events as text arrives and a final
+    `{"done": true, "timestamp": ...}` once the reply is complete and queued for saving.
+    """
+    user_id = ctx.user_id
+    context = await _build_chat_context(user_id)
+
+    user_ts = to_dt(datetime.utcnow())
+
+    async def event_stream():
+        parts: List[str] = []
+        assistant_ts: Optional[datetime] = None
+        try:
+            try:
+                async for text in gemini_stream(context, message.message):
+                    parts.append(text)
+                    yield f"data: {json.dumps({'delta': text})}\n\n"
+            except Exception as e:
+                logging.error(f"Error in chat stream: {e}")
+                yield f"data: {json.dumps({'error': 'Failed to get AI response'})}\n\n"
+                return
+
+            assistant_ts = to_dt(datetime.utcnow())
+            yield f"data: {json.dumps({'done': True, 'timestamp': assistant_ts.isoformat()})}\n\n"
+        finally:
+            # Runs on success, on error and when the client disconnects (cancellation / GeneratorExit):
+            # always keep the user's message, plus whatever part of the reply was produced
+            turn = [("user", message.message, user_ts)]
+            response = "".join(parts).strip()
+            if response:
+                turn.append(("assistant", response, assistant_ts or to_dt(datetime.utcnow())))
+            spawn_background(_save_chat_messages(user_id, turn))
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+@api_router.get("/chat/history", responses={200: {"model": ChatHistoryResponse}})
 async def get_chat_history(
     limit: int = 50,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
     rows = await fetch_all(
         "SELECT role, content, timestamp FROM chat_messages WHERE user_id=%s ORDER BY timestamp ASC LIMIT %s",
         (user_id, int(limit)),
     )
 
-    return ChatHistoryResponse(
-        messages=[
-            ChatMessageResponse(
-                role=row["role"], content=row["content"], timestamp=row["timestamp"]
-            )
-            for row in rows
-        ]
-    )
+    return ORJSONResponse({"messages": rows})
 
 # ==================== CHALLENGES ENDPOINTS ====================
 
@@ -783,30 +958,13 @@ class ChallengeCheckIn(BaseModel):
 @api_router.post("/challenges/create", response_model=ChallengeResponse)
 async def create_challenge(
     challenge: ChallengeCreate,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
     
     start_date = datetime.utcnow()
     end_date = start_date + timedelta(days=challenge.duration_days)
     
-    challenge_doc = {
-        "user_id": user_id,
-        **challenge.dict(),
-        "start_date": start_date,
-        "end_date": end_date,
-        "completed_days": 0,
-        "is_active": True,
-        "is_completed": False,
-        "badges": [],
-        "check_ins": [],
-        "created_at": start_date
-    }
-    
     new_id = await execute(
         """
         INSERT INTO challenges (
@@ -831,7 +989,7 @@ async def create_challenge(
         ),
     )
 
-    return ChallengeResponse(
+    return ChallengeResponse.model_construct(
         id=str(new_id),
         user_id=str(user_id),
         challenge_type=challenge.challenge_type,
@@ -848,15 +1006,11 @@ async def create_challenge(
     )
 
 @api_router.get("/challenges/active", response_model=List[ChallengeResponse])
-async def get_active_challenges(username: str = Depends(verify_token)):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+async def get_active_challenges(ctx: AuthCtx = Depends(verify_token)):
+    user_id = ctx.user_id
 
     rows = await fetch_all(
-        "SELECT * FROM challenges WHERE user_id=%s AND is_active=1",
+        "SELECT id, user_id, challenge_type, duration_days, title, description, start_date, end_date, completed_days, is_active, is_completed, badges, created_at FROM challenges WHERE user_id=%s AND is_active=1",
         (user_id,),
     )
     results: List[ChallengeResponse] = []
@@ -887,13 +1041,9 @@ async def get_active_challenges(username: str = Depends(verify_token)):
 @api_router.post("/challenges/checkin")
 async def challenge_checkin(
     checkin: ChallengeCheckIn,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
     try:
         challenge_id_int = int(checkin.challenge_id)
@@ -984,16 +1134,12 @@ class BodyMapSymptom(BaseModel):
 @api_router.post("/bodymap/analyze")
 async def analyze_symptom(
     symptom: BodyMapSymptom,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
     # Get user's health profile for context
-    profile = await fetch_one("SELECT * FROM health_profiles WHERE user_id=%s", (user_id,))
+    profile = await fetch_one("SELECT stress_level, exercise_frequency, sleep_hours FROM health_profiles WHERE user_id=%s", (user_id,))
 
     # Get recent symptoms
     recent_symptoms = await fetch_all(
@@ -1054,7 +1200,7 @@ Keep it concise and easy to understand. Remember this is general information, no
 async def _get_recent_timeline_entries(user_id: int, days: int = 7) -> List[Dict[str, Any]]:
     since = to_dt(datetime.utcnow() - timedelta(days=days))
     return await fetch_all(
-        "SELECT * FROM timeline_entries WHERE user_id=%s AND timestamp >= %s ORDER BY timestamp DESC",
+        "SELECT entry_type, severity, tags, timestamp FROM timeline_entries WHERE user_id=%s AND timestamp >= %s ORDER BY timestamp DESC",
         (user_id, since),
     )
 
@@ -1065,17 +1211,13 @@ async def _build_health_score_from_entries(entries: List[Dict[str, Any]]) -> Dic
 
 
 @api_router.get("/insights/patterns")
-async def get_health_patterns(username: str = Depends(verify_token)):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+async def get_health_patterns(ctx: AuthCtx = Depends(verify_token)):
+    user_id = ctx.user_id
 
     # Get timeline entries from last 30 days for general stats
     thirty_days_ago = to_dt(datetime.utcnow() - timedelta(days=30))
     entries = await fetch_all(
-        "SELECT * FROM timeline_entries WHERE user_id=%s AND timestamp >= %s",
+        "SELECT entry_type, tags, timestamp FROM timeline_entries WHERE user_id=%s AND timestamp >= %s",
         (user_id, thirty_days_ago),
     )
 
@@ -1166,13 +1308,9 @@ class ReminderResponse(BaseModel):
 @api_router.post("/reminders/create", response_model=ReminderResponse)
 async def create_reminder(
     reminder: ReminderCreate,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
     created_at = to_dt(datetime.utcnow())
     new_id = await execute(
@@ -1192,7 +1330,7 @@ async def create_reminder(
         ),
     )
 
-    return ReminderResponse(
+    return ReminderResponse.model_construct(
         id=str(new_id),
         user_id=str(user_id),
         reminder_type=reminder.reminder_type,
@@ -1205,12 +1343,8 @@ async def create_reminder(
     )
 
 @api_router.get("/reminders/active", response_model=List[ReminderResponse])
-async def get_active_reminders(username: str = Depends(verify_token)):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+async def get_active_reminders(ctx: AuthCtx = Depends(verify_token)):
+    user_id = ctx.user_id
 
     rows = await fetch_all(
         "SELECT * FROM reminders WHERE user_id=%s AND is_active=1",
@@ -1236,13 +1370,9 @@ async def get_active_reminders(username: str = Depends(verify_token)):
 @api_router.post("/reminders/{reminder_id}/toggle")
 async def toggle_reminder(
     reminder_id: str,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    user_id = int(user["id"])
+    user_id = ctx.user_id
 
     try:
         reminder_id_int = int(reminder_id)
@@ -1291,7 +1421,7 @@ async def extract_text_from_image(image_data: bytes) -> str:
         image_base64 = base64.b64encode(image_data).decode('utf-8')
         
         # Use Gemini with vision capabilities to extract text
-        model = genai.GenerativeModel(model_name=GEMINI_MODEL)
+        model = get_gemini_model()
         
         # Create the image part
         image_parts = [
@@ -1474,16 +1604,12 @@ Return ONLY valid JSON. If a field is unknown, do your own research and fill in
 @api_router.post("/prescriptions/upload", response_model=PrescriptionAnalysisResponse)
 async def upload_prescription(
     file: UploadFile = File(...),
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
     """Upload a prescription image, extract text, and get AI analysis."""
     
     # Verify user
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_id = int(user["id"])
+    user_id = ctx.user_id
     
     # Validate file type
     if not file.content_type or not file.content_type.startswith('image/'):
@@ -1503,11 +1629,11 @@ async def upload_prescription(
             )
         
         # Get user's health profile
-        profile = await fetch_one("SELECT * FROM health_profiles WHERE user_id=%s", (user_id,))
+        profile = await fetch_one("SELECT sleep_pattern, sleep_hours, stress_level, exercise_frequency, diet_type, existing_conditions FROM health_profiles WHERE user_id=%s", (user_id,))
         
         # Get recent timeline entries
         recent_logs = await fetch_all(
-            "SELECT * FROM timeline_entries WHERE user_id=%s ORDER BY timestamp DESC LIMIT 20",
+            "SELECT entry_type, title, severity FROM timeline_entries WHERE user_id=%s ORDER BY timestamp DESC LIMIT 10",
             (user_id,)
         )
         
@@ -1589,15 +1715,11 @@ async def upload_prescription(
 @api_router.get("/prescriptions/history", response_model=List[PrescriptionAnalysisResponse])
 async def get_prescription_history(
     limit: int = 20,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
     """Get user's prescription history."""
     
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_id = int(user["id"])
+    user_id = ctx.user_id
     
     prescriptions = await fetch_all(
         """
@@ -1634,15 +1756,11 @@ async def get_prescription_history(
 @api_router.get("/prescriptions/{prescription_id}", response_model=PrescriptionAnalysisResponse)
 async def get_prescription(
     prescription_id: str,
-    username: str = Depends(verify_token)
+    ctx: AuthCtx = Depends(verify_token)
 ):
     """Get a specific prescription by ID."""
     
-    user = await fetch_one("SELECT id FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_id = int(user["id"])
+    user_id = ctx.user_id
     
     try:
         prescription_id_int = int(prescription_id)
@@ -1676,7 +1794,6 @@ async def get_prescription(
 # ==================== HEALTH REPORT GENERATION ====================
 
 from pdf_generator import create_health_report_pdf
-from fastapi.responses import StreamingResponse
 
 @api_router.post("/health/generate-report")
 @api_router.get("/health/generate-report")
@@ -1688,17 +1805,13 @@ async def generate_health_report(
     if token:
         from fastapi.security import HTTPAuthorizationCredentials as Creds
         credentials = Creds(scheme="Bearer", credentials=token)
-        username = await verify_token(credentials)
+        ctx = await verify_token(credentials)
     else:
         # Fall back to header-based auth
         raise HTTPException(status_code=401, detail="Token required")
     
-    # Fetch user
-    user = await fetch_one("SELECT * FROM users WHERE username=%s", (username,))
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-    
-    user_id = int(user["id"])
+    username = ctx.username
+    user_id = ctx.user_id
     
     try:
         # Fetch health profile
@@ -1738,7 +1851,7 @@ async def generate_health_report(
             timeline_entries.append(entry_dict)
         
         # Fetch insights data
-        insights = await get_health_patterns(username)
+        insights = await get_health_patterns(ctx)
         
         # Get health score
         recent_entries = await _get_recent_timeline_entries(user_id, days=7)
@@ -1866,12 +1979,20 @@ async def health_check():
 # Include router
 app.include_router(api_router)
 
+# Only browser clients (Expo web) are subject to CORS; the native apps don't send an Origin.
+CORS_ALLOW_ORIGINS = [
+    origin.strip()
+    for origin in os.environ.get('CORS_ALLOW_ORIGINS', 'http://localhost:8081,http://localhost:19006').split(',')
+    if origin.strip()
+]
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ALLOW_ORIGINS,
+    allow_methods=["GET", "POST"],
+    allow_headers=["Authorization", "Content-Type"],
+    max_age=86400,
 )
 
 # Configure logging
@@ -1888,10 +2009,21 @@ async def on_startup():
     # Initialize tables
     async with db_pool.acquire() as conn:
         await init_db(conn)
+    persona_batcher.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
     global db_pool
+    await persona_batcher.stop()
+    # Let pending background writes (e.g. chat turns already answered) finish before the pool goes away
+    if _bg_tasks:
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*_bg_tasks, return_exceptions=True),
+                timeout=BACKGROUND_SHUTDOWN_TIMEOUT,
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {len(_bg_tasks)} background task(s) still pending")
     if db_pool is not None:
         db_pool.close()
         await db_pool.wait_closed()